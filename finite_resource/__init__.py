@@ -1,11 +1,41 @@
+import bisect
 import collections
-from asyncio import mixins, exceptions
-from contextlib import asynccontextmanager
+import heapq
+import itertools
+from asyncio import get_running_loop, AbstractEventLoop, Future
 from typing import Optional, Any
 
+# Type of the value of a resource and of its leases: `int`, `float` or `Decimal`. Not a `Union`,
+# which would reject mixing `int` and `Decimal` values although they support arithmetic together.
+_Value = Any
+
+# Increasing ids giving the FIFO order of waiters across the queues of different values
+_waiter_ids = itertools.count()
+
+
+class _Lease:
+    """Async context manager returned by `FiniteResource.use`, may only be used once."""
+
+    __slots__ = ("_resource", "_value")
+
+    def __init__(self, resource: "FiniteResource", value: _Value) -> None:
+        self._resource = resource
+        self._value = value
+
+    async def __aenter__(self) -> "FiniteResource":
+        resource = self._resource
+        if not resource.try_acquire(self._value):
+            await resource.acquire(self._value)
+        return resource
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self._resource.release(self._value)
+        # Prevent re-using the context manager, `__aenter__` raises `AttributeError` from now on
+        del self._resource
+
 
 # Most of this code is copied from asyncio.Semaphore and asyncio.BoundedSemaphore
-class FiniteResource(mixins._LoopBoundMixin):
+class FiniteResource:
     """A FiniteResource implementation.
 
     FiniteResource supports the context management protocol via the `use` method.
@@ -15,66 +45,84 @@ class FiniteResource(mixins._LoopBoundMixin):
     ValueError is raised.
     """
 
-    @asynccontextmanager
-    async def use(self, value):
-        await self.acquire(value)
-        try:
-            yield
-        finally:
-            self.release(value)
+    __slots__ = (
+        "_waiters",
+        "_queues",
+        "_queue_values",
+        "_n_queued",
+        "_value",
+        "_loop",
+        "__weakref__",
+    )
 
-    def __init__(self, value):
+    def use(self, value: _Value) -> _Lease:
+        return _Lease(self, value)
+
+    def __init__(self, value: _Value) -> None:
         if value < 0:
             raise ValueError("initial value must be >= 0")
-        self._waiters = None
-        self._value = value
+        # Maps the future of each waiter to the value it requested, waiters are removed in O(1).
+        self._waiters: Optional[dict[Future, _Value]] = None
+        # FIFO queue of `(id, fut)` entries per requested value, and the sorted list of these
+        # values, so the waiters that fit in a value are found without scanning `_waiters`.
+        # Entries whose future is done are dropped lazily, `_n_queued` counts all entries.
+        # These are only allocated while there are waiters.
+        self._queues: Optional[dict[_Value, collections.deque[tuple[int, Future]]]] = None
+        self._queue_values: Optional[list[_Value]] = None
+        self._n_queued = 0
+        self._value: _Value = value
+        self._loop: Optional[AbstractEventLoop] = None
 
-    def __repr__(self):
-        res = super().__repr__()
+    def __repr__(self) -> str:
+        cls = type(self)
         extra = "locked" if self.locked() else f"unlocked, value:{self._value}"
         if self._waiters:
             extra = f"{extra}, waiters:{len(self._waiters)}"
-        return f"<{res[1:-1]} [{extra}]>"
+        return f"<{cls.__module__}.{cls.__qualname__} object at {id(self):#x} [{extra}]>"
 
-    def locked_for_value(self, value):
-        return self._value < value or (
-            any(
-                (self._value >= v) and (not w.cancelled())
-                for (v, w) in (self._waiters or ())
-            )
-        )
+    def locked_for_value(self, value: _Value) -> bool:
+        return self._value < value or self._waiter_fits()
 
-    def locked(self):
+    def locked(self) -> bool:
         """Returns True if resource cannot be acquired immediately."""
         # Due to state, or FIFO rules (must allow others to run first).
-        return self._value == 0 or (
-            any(
-                (self._value >= v) and (not w.cancelled())
-                for (v, w) in (self._waiters or ())
-            )
-        )
+        return self._value == 0 or self._waiter_fits()
+
+    def try_acquire(self, value: _Value) -> bool:
+        """Acquire a lease for `value` if it is available right now, without waiting.
 
-    async def acquire(self, value):
+        Returns True if the lease was acquired, False otherwise. Never yields to the event loop.
+        """
         if self._value >= value:
-            # Maintain FIFO, wait for others to start even if _value > 0.
             self._value -= value
             return True
+        return False
 
-        if self._waiters is None:
-            self._waiters = collections.deque()
-        fut = self._get_loop().create_future()
-        vf = (value, fut)
-        self._waiters.append(vf)
+    async def acquire(self, value: _Value) -> bool:
+        # Same check as `try_acquire`, inlined to save a call on the uncontended path
+        if self._value >= value:
+            self._value -= value
+            return True
+
+        # Only look up and bind the running loop the first time, awaiting a future of another
+        # loop still raises a RuntimeError in the task.
+        loop = self._loop or self._get_loop()
+        # Futures are deliberately not pooled: the C `Future` cannot be reset to pending, and a
+        # done future may still be referenced by `_queues` until it is pruned, so recycling
+        # it would bring a finished waiter back to life.
+        fut = loop.create_future()
+        self._add_waiter(fut, value)
 
         try:
             try:
                 await fut
             finally:
-                self._waiters.remove(vf)
-        except exceptions.CancelledError:
-            # Currently the only exception designed be able to occur here.
+                self._remove_waiter(fut)
+        except BaseException:
+            # Cancellation is the only exception designed to occur here, but the `RuntimeError` of
+            # a different loop or `GeneratorExit` may also arrive after our Future was set.
             if fut.done() and not fut.cancelled():
-                # Our Future was successfully set to True via _wake_up_next(),
+                # Our Future was successfully set to True via _wake_up_batch(),
                 # but we are not about to successfully acquire(). Therefore we
                 # must undo the bookkeeping already done and attempt to wake
                 # up someone else.
@@ -84,52 +132,181 @@ class FiniteResource(mixins._LoopBoundMixin):
         finally:
             # New waiters may have arrived but had to wait due to FIFO.
             # Wake up as many as are allowed.
-            while self._value > 0:
-                if not self._wake_up_next():
-                    break  # There was no-one to wake up.
+            self._wake_up_batch()
         return True
 
-    def release(self, value):
+    def release(self, value: _Value) -> None:
         self._value += value
-        self._wake_up_next()
+        self._wake_up_batch()
 
-    def _wake_up_next(self):
-        """Wake up the first waiter that isn't done."""
-        if not self._waiters:
+    def _get_loop(self) -> AbstractEventLoop:
+        """Return the running loop, binding the resource to it on first use."""
+        loop = get_running_loop()
+        if self._loop is None:
+            self._loop = loop
+        elif loop is not self._loop:
+            raise RuntimeError(f"{self!r} is bound to a different event loop")
+        return loop
+
+    def _add_waiter(self, fut: Future, value: _Value) -> None:
+        if self._waiters is None:
+            self._waiters = {}
+            self._queues = {}
+            self._queue_values = []
+        self._waiters[fut] = value
+        queues = self._queues
+        queue_values = self._queue_values
+        assert queues is not None and queue_values is not None
+        queue = queues.get(value)
+        if queue is None:
+            queue = queues[value] = collections.deque()
+            bisect.insort(queue_values, value)
+        queue.append((next(_waiter_ids), fut))
+        self._n_queued += 1
+
+    def _remove_waiter(self, fut: Future) -> None:
+        waiters = self._waiters
+        assert waiters is not None
+        del waiters[fut]
+        if not fut.done():
+            # `acquire` left without being woken up or cancelled, e.g. on `GeneratorExit` or the
+            # `RuntimeError` of a different loop. Cancel the future so that its entry in `_queues`
+            # is skipped like the other done ones, instead of being handed the value.
+            fut.cancel()
+        if not waiters:
+            # Nobody is waiting anymore, any entry left in `_queues` is done.
+            self._waiters = None
+            self._queues = None
+            self._queue_values = None
+            self._n_queued = 0
+        elif self._n_queued > 2 * len(waiters):
+            self._compact_queues()
+
+    def _queue_head(self, value: _Value) -> Optional[tuple[int, Future]]:
+        """Return the `(id, fut)` entry of the first waiter for `value` that isn't done, or None."""
+        queues = self._queues
+        assert queues is not None
+        queue = queues[value]
+        while queue and queue[0][1].done():
+            queue.popleft()
+            self._n_queued -= 1
+        return queue[0] if queue else None
+
+    def _min_pending_value(self) -> Optional[_Value]:
+        """Return the smallest value requested by a waiter that isn't done, or None."""
+        values = self._queue_values
+        while values:
+            value = values[0]
+            if self._queue_head(value) is not None:
+                return value
+            # Only done waiters were queued for this value
+            queues = self._queues
+            assert queues is not None
+            del queues[value]
+            del values[0]
+        return None
+
+    def _waiter_fits(self) -> bool:
+        """Returns True if a waiter that isn't done fits in the available value."""
+        if not self._queue_values:
             return False
+        min_pending_value = self._min_pending_value()
+        return min_pending_value is not None and self._value >= min_pending_value
 
-        for value, fut in self._waiters:
-            if not fut.done() and (self._value >= value):
-                self._value -= value
-                fut.set_result(True)
-                # `fut` is now `done()` and not `cancelled()`.
-                return True
-        return False
+    def _compact_queues(self) -> None:
+        """Drop the entries of waiters that are done from the queues."""
+        old_queues = self._queues
+        queue_values = self._queue_values
+        assert old_queues is not None and queue_values is not None
+        queues = {}
+        for value in queue_values:
+            queue = collections.deque(
+                entry for entry in old_queues[value] if not entry[1].done()
+            )
+            if queue:
+                queues[value] = queue
+        self._queues = queues
+        self._queue_values = [value for value in queue_values if value in queues]
+        self._n_queued = sum(map(len, queues.values()))
+
+    def _wake_up_batch(self) -> None:
+        """Wake up, in FIFO order, as many waiters that aren't done as the value allows."""
+        if not self._waiters:
+            return
+
+        min_pending_value = self._min_pending_value()
+        if min_pending_value is None or self._value < min_pending_value:
+            # No waiter fits in the available value, no need to look at them.
+            return
+
+        # Waking up a waiter only decreases the value, so a waiter that does not fit now
+        # will not fit later in this pass either. Repeatedly waking the oldest waiter that
+        # fits is therefore the same as a single FIFO pass over the waiters, but only needs to
+        # look at the head of the queue of each value that fits.
+        remaining = self._value
+        queues = self._queues
+        values = self._queue_values
+        assert queues is not None and values is not None
+        heads = []
+        for value in values[: bisect.bisect_right(values, remaining)]:
+            head = self._queue_head(value)
+            if head is not None:
+                heads.append((head[0], value))
+        heapq.heapify(heads)
+
+        while heads and remaining >= min_pending_value:
+            _, value = heapq.heappop(heads)
+            if remaining < value:
+                continue  # No waiter for this value can fit anymore.
+            _, fut = queues[value].popleft()
+            self._n_queued -= 1
+            remaining -= value
+            fut.set_result(True)
+            # `fut` is now `done()` and not `cancelled()`.
+            if remaining >= value:
+                head = self._queue_head(value)
+                if head is not None:
+                    heapq.heappush(heads, (head[0], value))
+        self._value = remaining
 
 
 class BoundedFiniteResource(FiniteResource):
-    _want_to_decrement_value: Optional[Any] = None
+    __slots__ = ("_bound_value", "_want_to_decrement_value")
 
-    def __init__(self, value=1):
+    def __init__(self, value: _Value = 1) -> None:
         self._bound_value = value
+        self._want_to_decrement_value: Optional[_Value] = None
         super().__init__(value)
 
-    def release(self, value):
+    def release(self, value: _Value) -> None:
         if self._want_to_decrement_value:
-            # In case the `bound_value` has been updated while there were active leases,
-            # we allow the active leases to release "cleanly", but will not increment the value
-            # This means, however, that if someone without an active lease calls `release` before the
-            # active leases, there might be a race condition when the active lease calls `release`,
-            # as only at that time will we raise the `ValueError` due to trying to release too many times
-            decrement_amount = min(value, self._want_to_decrement_value)
-            self._value -= decrement_amount
-            self._want_to_decrement_value -= decrement_amount
+            self._release_with_pending_decrement(value)
+            return
         if self._value >= self._bound_value:
             raise ValueError("released too many times")
         self._value += value
-        self._wake_up_next()
+        self._wake_up_batch()
 
-    def update_bound_value(self, new_value) -> tuple[bool, Any]:
+    def _release_with_pending_decrement(self, value: _Value) -> None:
+        # In case the `bound_value` has been updated while there were active leases,
+        # we allow the active leases to release "cleanly", but will not increment the value
+        # This means, however, that if someone without an active lease calls `release` before the
+        # active leases, there might be a race condition when the active lease calls `release`,
+        # as only at that time will we raise the `ValueError` due to trying to release too many times
+        want_to_decrement_value = self._want_to_decrement_value
+        assert want_to_decrement_value is not None
+        decrement_amount = (
+            value if value < want_to_decrement_value else want_to_decrement_value
+        )
+        current_value = self._value - decrement_amount
+        if current_value >= self._bound_value:
+            raise ValueError("released too many times")
+        self._want_to_decrement_value = want_to_decrement_value - decrement_amount
+        # Single update of the value for the pending decrement and the release itself
+        self._value = current_value + value
+        self._wake_up_batch()
+
+    def update_bound_value(self, new_value: _Value) -> tuple[bool, _Value]:
         """Change the bounded maximum value to a different value"""
         diff = new_value - self._bound_value
         if diff == 0:
@@ -142,18 +319,21 @@ class BoundedFiniteResource(FiniteResource):
             self._want_to_decrement_value = None
             # Since we are incrementing value, this is similar as calling `release`, as we are making available new
             # potential leases, so we will check now if we can wake up any waiters
-            self._wake_up_next()
+            self._wake_up_batch()
             return True, 0
         else:  # decrement, more complex
-            value_of_active_leases = self._bound_value - self._value
             want_to_decrement_by = -diff
-            # decrement the amount that we can decrement now safely
-            # self._value should never be less than 0, so value_of_active_leases should never be negative unless
-            # there is some illegal lease
-            n_can_decrement_safely = max(0, self._bound_value - value_of_active_leases)
+            # decrement the amount that we can decrement now safely, which is the value not held by active leases
+            # (`self._bound_value - (self._bound_value - self._value)`, computed without the two subtractions)
+            # self._value should never be less than 0 unless there is some illegal lease
+            n_can_decrement_safely = self._value
             if n_can_decrement_safely > 0:
                 # decrement up to the maximum amount we want to decrement by
-                n_decrement_by = min(want_to_decrement_by, n_can_decrement_safely)
+                n_decrement_by = (
+                    want_to_decrement_by
+                    if want_to_decrement_by < n_can_decrement_safely
+                    else n_can_decrement_safely
+                )
                 self._value -= n_decrement_by
                 want_to_decrement_by -= n_decrement_by
 
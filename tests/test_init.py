@@ -1,4 +1,5 @@
 import asyncio
+import weakref
 
 import pytest
 from finite_resource import FiniteResource, BoundedFiniteResource
@@ -253,3 +254,198 @@ async def test_bounded_context_manager():
     fr.update_bound_value(20)
     await asyncio.sleep(0.011)
     assert task_4.done()
+
+
+@pytest.mark.asyncio
+async def test_locked_ignores_done_waiters():
+    fr = FiniteResource(value=0)
+    task_1 = asyncio.create_task(fr.acquire(1))
+    task_2 = asyncio.create_task(fr.acquire(3))
+    await asyncio.sleep(0)
+
+    fr.release(2)
+    await asyncio.sleep(0)
+    assert task_1.done()
+    assert not fr.locked()
+    assert fr.locked_for_value(2)
+
+    task_2.cancel()
+    await asyncio.sleep(0)
+    assert task_2.cancelled()
+    assert not fr.locked()
+    assert not fr.locked_for_value(1)
+    assert fr._waiters is None
+    assert fr._queues is None
+
+
+@pytest.mark.asyncio
+async def test_release_wakes_up_batch():
+    fr = FiniteResource(value=0)
+    task_1 = asyncio.create_task(fr.acquire(2))
+    task_2 = asyncio.create_task(fr.acquire(5))
+    task_3 = asyncio.create_task(fr.acquire(1))
+    task_4 = asyncio.create_task(fr.acquire(1))
+    await asyncio.sleep(0)
+
+    # a single release wakes up every waiter that fits, in FIFO order
+    fr.release(4)
+    assert fr._value == 0
+    await asyncio.sleep(0)
+    assert task_1.done()
+    assert not task_2.done()
+    assert task_3.done()
+    assert task_4.done()
+
+    fr.release(5)
+    await asyncio.sleep(0)
+    assert task_2.done()
+    assert fr._value == 0
+
+
+@pytest.mark.asyncio
+async def test_try_acquire():
+    fr = FiniteResource(value=3)
+    assert fr.try_acquire(2) is True
+    assert fr._value == 1
+    assert fr.try_acquire(2) is False
+    assert fr._value == 1
+
+    task_1 = asyncio.create_task(fr.acquire(2))
+    await asyncio.sleep(0)
+    assert not task_1.done()
+    # a value that fits may still be acquired
+    assert fr.try_acquire(1) is True
+    assert fr._value == 0
+
+    fr.release(3)
+    await asyncio.sleep(0)
+    assert task_1.done()
+    assert fr._value == 1
+
+
+@pytest.mark.asyncio
+async def test_bounded_waiters_larger_than_bound():
+    fr = BoundedFiniteResource(value=2)
+    assert await fr.acquire(2)
+    task_1 = asyncio.create_task(fr.acquire(3))
+    await asyncio.sleep(0)
+    task_2 = asyncio.create_task(fr.acquire(1))
+    await asyncio.sleep(0)
+    assert "waiters:2" in repr(fr)
+
+    # FIFO is respected once the larger waiter fits in the bound
+    fr.update_bound_value(5)
+    await asyncio.sleep(0)
+    assert task_1.done()
+    assert not task_2.done()
+    assert fr._value == 0
+    fr.release(2)
+    await asyncio.sleep(0)
+    assert task_2.done()
+
+    # the value may exceed the bound after the bound has been raised again
+    fr = BoundedFiniteResource(value=10)
+    assert await fr.acquire(7)
+    fr.update_bound_value(2)
+    fr.update_bound_value(4)
+    task_3 = asyncio.create_task(fr.acquire(5))
+    await asyncio.sleep(0)
+    fr.release(7)
+    await asyncio.sleep(0)
+    assert task_3.done()
+    assert fr._value == 4
+
+
+def test_bound_to_event_loop():
+    fr = FiniteResource(value=1)
+
+    async def _acquire(value):
+        task = asyncio.create_task(fr.acquire(value))
+        await asyncio.sleep(0)
+        fr.release(value)
+        return await task
+
+    assert asyncio.run(_acquire(2))
+    assert "FiniteResource object at" in repr(fr)
+    with pytest.raises(RuntimeError):
+        asyncio.run(_acquire(2))
+    # the failed waiter did not stay queued
+    assert fr._waiters is None
+    assert fr._queues is None
+    assert fr._n_queued == 0
+    assert fr._value == 3
+
+
+@pytest.mark.asyncio
+async def test_bounded_release_too_many_times_with_pending_decrement():
+    fr = BoundedFiniteResource(value=10)
+    assert await fr.acquire(7)
+    task_1 = asyncio.create_task(fr.acquire(5))
+    await asyncio.sleep(0)
+    fr.release(7)  # task_1 is woken up, value 5
+    task_1.cancel()  # ... but cancelled before it runs
+    # the decrement cannot be done yet, as task_1 still counts as an active lease
+    assert fr.update_bound_value(1) == (False, 4)
+    await asyncio.sleep(0)
+    assert task_1.cancelled()
+    # task_1 gave its value back without going through `release`
+    assert fr._value == 5
+    assert fr._want_to_decrement_value == 4
+
+    with pytest.raises(ValueError):
+        fr.release(1)
+    # a failed release has no effect on the pending decrement
+    assert fr._value == 5
+    assert fr._want_to_decrement_value == 4
+
+
+def test_weakref():
+    fr = BoundedFiniteResource(value=1)
+    ref = weakref.ref(fr)
+    assert ref() is fr
+    resources = weakref.WeakSet([fr, FiniteResource(value=1)])
+    assert list(resources) == [fr]
+
+
+@pytest.mark.asyncio
+async def test_acquire_closed_while_waiting():
+    fr = FiniteResource(value=0)
+    coro = fr.acquire(1)
+    coro.send(None)  # waiting, outside of a task
+    task_1 = asyncio.create_task(fr.acquire(1))
+    await asyncio.sleep(0)
+
+    coro.close()  # leaves `acquire` with `GeneratorExit`, the future is not done
+    fr.release(1)
+    await asyncio.sleep(0)
+    # the value was not given to the closed waiter
+    assert task_1.done()
+    assert fr._value == 0
+    assert fr._waiters is None
+
+
+@pytest.mark.asyncio
+async def test_compact_queues():
+    fr = FiniteResource(value=0)
+    live_values = [2, 1, 3, 1, 2, 3]
+    live = [asyncio.create_task(fr.acquire(v)) for v in live_values]
+    cancelled = [asyncio.create_task(fr.acquire(1 + i % 3)) for i in range(60)]
+    await asyncio.sleep(0)
+    assert fr._n_queued == 66
+
+    for task in cancelled:
+        task.cancel()
+    await asyncio.sleep(0)
+    # the queues were compacted while the cancelled waiters left
+    assert len(fr._waiters) == len(live)
+    assert fr._n_queued <= 2 * len(fr._waiters)
+
+    # the remaining waiters are still woken up in FIFO order
+    order = []
+    for i, task in enumerate(live):
+        task.add_done_callback(lambda _, i=i: order.append(i))
+    fr.release(sum(live_values))
+    await asyncio.gather(*live)
+    assert order == list(range(len(live)))
+    assert fr._value == 0
+    assert fr._waiters is None
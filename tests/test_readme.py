@@ -1,5 +1,6 @@
 import pytest
 import os.path
+import textwrap
 
 
 def test_readme():
@@ -10,7 +11,7 @@ def test_readme():
         lines = f.readlines()
 
     python_code_blocks = []
-    code_block = ""
+    code_block_lines: list[str] = []
     active_block = False
     for line in lines:
         if line.strip() == "```python":
@@ -18,15 +19,15 @@ def test_readme():
             continue
         elif line.strip() == "```":
             active_block = False
-            if code_block:
-                python_code_blocks.append(code_block)
-            code_block = ""
+            if code_block_lines:
+                python_code_blocks.append("".join(code_block_lines))
+            code_block_lines = []
             continue
         if active_block:
-            code_block += line
+            code_block_lines.append(line)
 
-    for code in python_code_blocks:
-        indented_code = "    " + code.replace("\n", "\n    ")
+    for i, code in enumerate(python_code_blocks):
+        indented_code = textwrap.indent(code, "    ")
         wrapper = (
             "import asyncio"
             + "\n"
@@ -36,4 +37,5 @@ def test_readme():
             + "asyncio.run(main())"
         )
         print(wrapper)
-        exec(wrapper)
+        # a fresh namespace per block, so blocks don't see each other's names
+        exec(compile(wrapper, f"<README.md block {i}>", "exec"), {})